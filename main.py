@@ -1,13 +1,35 @@
 import os
+import html
+import time
+import signal
 import asyncio
 import logging
-from flask import Flask
-from threading import Thread
+import functools
+from contextlib import suppress
+from dataclasses import dataclass
+from itertools import count
+from collections import OrderedDict
+from cachetools import TTLCache
+from aiohttp import web
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
+from telegram.ext import AIORateLimiter, Application, ChatMemberHandler, CommandHandler, CallbackQueryHandler, MessageHandler, PersistenceInput, PicklePersistence, filters, ContextTypes
 from telegram.helpers import escape_markdown
 from telegram.constants import ChatMemberStatus
+from telegram.error import BadRequest, TelegramError
+from telegram.request import HTTPXRequest
+
+try:
+    import orjson
+except ImportError:
+    # orjson is optional, the standard json module is used without it
+    orjson = None
+
+try:
+    import uvloop
+except ImportError:
+    # uvloop is optional (and not available on Windows), asyncio's default loop is used without it
+    uvloop = None
 
 # Load environment variables
 load_dotenv()
@@ -28,69 +50,440 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 CHANNEL_ID = os.getenv('CHANNEL_ID')
 CHANNEL_URL = os.getenv('CHANNEL_URL')
 WARNING_IMAGE_URL = os.getenv('WARNING_IMAGE_URL')
+# File that keeps known channel members between restarts
+PERSISTENCE_FILE = os.getenv('PERSISTENCE_FILE', 'bot_data.pickle')
+
+def _derive_subscribe_url(channel_url, channel_id):
+    """Build the channel subscription URL from configuration, or None if unknown"""
+    # Priority 1: Use CHANNEL_URL if provided
+    if channel_url:
+        if channel_url.startswith(('https://', 'http://')):
+            return channel_url
+        if channel_url.startswith('@'):
+            return f"https://t.me/{channel_url[1:]}"
+        return None
+    
+    # Priority 2: Derive URL from CHANNEL_ID if it starts with @
+    if channel_id and channel_id.startswith('@'):
+        return f"https://t.me/{channel_id[1:]}"
+    return None
+
+SUBSCRIBE_URL = _derive_subscribe_url(CHANNEL_URL, CHANNEL_ID)
+
+def _build_subscription_prompt():
+    """Build the subscription required text and inline keyboard"""
+    text = "⚠️ Botdan foydalanish uchun quyidagi kanalga obuna bo'ling."
+    
+    # Show channel ID in message for numeric IDs
+    if not SUBSCRIBE_URL and not CHANNEL_URL and CHANNEL_ID:
+        text += f"\n\n🆔 Kanal ID: <code>{html.escape(CHANNEL_ID)}</code>\n📝 Admin bilan bog'laning yoki kanalning public username'ini so'rang."
+    
+    # Create keyboard
+    keyboard = []
+    if SUBSCRIBE_URL:
+        keyboard.append([InlineKeyboardButton("✅ Obuna bo'lish", url=SUBSCRIBE_URL)])
+    
+    keyboard.append([InlineKeyboardButton("🔄 Tekshirish", callback_data="check_subscription")])
+    return text, InlineKeyboardMarkup(keyboard)
+
+# The subscription prompt never changes after startup, so build it once
+SUBSCRIPTION_TEXT, SUBSCRIPTION_MARKUP = _build_subscription_prompt()
+# The placeholder URL from the example config is treated as "no image"
+SEND_WARNING_IMAGE = bool(WARNING_IMAGE_URL) and WARNING_IMAGE_URL != "https://example.com/warning.png"
+
+# Welcome message with user name and number
+WELCOME_TEMPLATE = (
+    "👋 Salom, <b>{name}</b> botimizga xush kelibsiz! "
+    "Siz botdagi <b>{count}</b>-foydalanuvchi bo'ldingiz. "
+    "💬 Bu bot orqali foydalanuvchi, guruh va kanallarning ID'sini olish imkoniyatiga ega bo'lasiz. "
+    "⭐ Botga start tugmasini bosib, ish faoliyatini boshlang."
+)
+
+# Search menu shown to subscribed users
+SEARCH_MENU_TEXT = "✅ Obuna bo'lingan! Siz botdan foydalanishingiz mumkin.\n\n🔍 Qidirish turini tanlang:"
+SEARCH_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("👤 Foydalanuvchi qidirish", callback_data="search_user")],
+    [InlineKeyboardButton("📺 Kanal qidirish", callback_data="search_channel")],
+    [InlineKeyboardButton("👥 Guruh qidirish", callback_data="search_group")]
+])
+BACK_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Orqaga", callback_data="search_back")]])
+
+# Search result messages (MarkdownV2, static parts are pre-escaped)
+CHANNEL_FOUND_TEMPLATE = (
+    "✅ *Kanal topildi\\!*\n\n"
+    "📺 *Nomi:* {title}\n"
+    "{username_line}"
+    "🆔 *ID:* `{chat_id}`\n"
+    "👥 *Turi:* {chat_type}\n"
+    "{description_line}"
+)
+GROUP_FOUND_TEMPLATE = (
+    "✅ *Guruh topildi\\!*\n\n"
+    "👥 *Nomi:* {title}\n"
+    "{username_line}"
+    "🆔 *ID:* `{chat_id}`\n"
+    "👥 *Turi:* {chat_type}\n"
+    "{description_line}"
+)
+USERNAME_LINE_TEMPLATE = "🆔 *Username:* @{username}\n"
+DESCRIPTION_LINE_TEMPLATE = "📝 *Tavsif:* {description}\\.\\.\\."
+USER_SEARCH_LIMIT_TEMPLATE = (
+    "⚠️ *Foydalanuvchi qidirish cheklovi*\n\n"
+    "Afsuski, Telegram Bot API orqali @{name} foydalanuvchisini username bo'yicha qidirish mumkin emas\\.\n\n"
+    "*Foydalanuvchi ID\\-sini olish usullari:*\n"
+    "• Foydalanuvchi botga yozishi va /start bosishi kerak\n"
+    "• Yoki foydalanuvchini guruhlarda mention qilib, bot orqali ID\\-sini olish mumkin\n\n"
+    "*Maslahat:* Kanal yoki guruh qidirish funksiyasidan foydalaning\\!"
+)
+CHANNEL_NOT_FOUND_TEMPLATE = (
+    "❌ *Kanal topilmadi\\!*\n\n"
+    "@{name} kanal topilmadi yoki bot unga kirish huquqiga ega emas\\.\n\n"
+    "💡 *Maslahatlar:*\n"
+    "• Kanal username'i to'g'ri yozilganligini tekshiring\n"
+    "• Kanal ochiq \\(public\\) bo'lishi kerak\n"
+    "• Kanal mavjudligini tekshiring"
+)
+GROUP_NOT_FOUND_TEMPLATE = (
+    "❌ *Guruh topilmadi\\!*\n\n"
+    "@{name} guruh topilmadi yoki bot unga kirish huquqiga ega emas\\.\n\n"
+    "💡 *Maslahatlar:*\n"
+    "• Guruh username'i to'g'ri yozilganligini tekshiring\n"
+    "• Guruh ochiq \\(public\\) bo'lishi kerak\n"
+    "• Guruh mavjudligini tekshiring"
+)
+
+@dataclass(frozen=True)
+class SearchKind:
+    """Prompt, reply templates and lookup mode for one kind of search"""
+    label: str
+    prompt: str
+    found_template: str
+    not_found_template: str | None = None
+    needs_api_call: bool = True
+
+# Search kinds keyed by the search state they are waiting in
+SEARCH_KINDS = {
+    # Telegram Bot API can't look users up by username, so this search only explains the limitation
+    "waiting_user_search": SearchKind(
+        label="user",
+        prompt="👤 <b>Foydalanuvchi qidirish</b>\n\nFoydalanuvchi username'ini kiriting (masalan: @username yoki username):",
+        found_template=USER_SEARCH_LIMIT_TEMPLATE,
+        needs_api_call=False
+    ),
+    "waiting_channel_search": SearchKind(
+        label="channel",
+        prompt="🔍 <b>Kanal qidirish</b>\n\nKanal username'ini kiriting (masalan: @channelname yoki channelname):",
+        found_template=CHANNEL_FOUND_TEMPLATE,
+        not_found_template=CHANNEL_NOT_FOUND_TEMPLATE
+    ),
+    "waiting_group_search": SearchKind(
+        label="group",
+        prompt="🔍 <b>Guruh qidirish</b>\n\nGuruh username'ini kiriting (masalan: @groupname yoki groupname):",
+        found_template=GROUP_FOUND_TEMPLATE,
+        not_found_template=GROUP_NOT_FOUND_TEMPLATE
+    )
+}
 
 # User counter (in production, use a database)
-user_count = 0
+_user_counter = count(1)
+
+# Search states for users (keyed by (chat_id, user_id) tuple), abandoned searches expire after 5 minutes
+user_search_states = TTLCache(maxsize=50000, ttl=300)
+
+# Subscription check cache: results are reused for _SUB_TTL seconds
+_SUB_TTL = 60.0
+_SUB_CACHE_MAXSIZE = 10000
+# Known members are re-checked with the API after this many seconds, in case a leave was missed
+# (Telegram drops updates that aren't fetched within about 24 hours, e.g. while the bot sleeps)
+_MEMBER_MAX_AGE = 24 * 60 * 60
+
+# Channel member statuses that count as subscribed
+_SUBSCRIBED_STATUSES = frozenset({ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER})
+
+class OrjsonRequest(HTTPXRequest):
+    """HTTPXRequest that parses Bot API responses with orjson when it is installed"""
+    
+    @staticmethod
+    def parse_json_payload(payload):
+        if orjson is not None:
+            try:
+                return orjson.loads(payload)
+            except orjson.JSONDecodeError:
+                # Let the default parser handle invalid UTF-8 and report bad responses
+                pass
+        return HTTPXRequest.parse_json_payload(payload)
+
+class MessageRateLimiter(AIORateLimiter):
+    """AIORateLimiter that only applies the per-group limit to requests that post into a chat
+    
+    AIORateLimiter counts every request with a channel/group chat_id against that chat's group
+    limit, so get_chat_member(CHANNEL_ID, ...) for all users would share one bucket of a few calls
+    per minute. Telegram's group limit is about messages, so lookups skip it and only count
+    towards the overall rate.
+    """
+    
+    _LOOKUP_ENDPOINTS = frozenset({"getChatMember", "getChat"})
+    
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if endpoint in self._LOOKUP_ENDPOINTS:
+            # Without a chat_id the request is only limited by the overall rate. The callback
+            # gets the unchanged data through args.
+            data = {key: value for key, value in data.items() if key != "chat_id"}
+        return await super().process_request(callback, args, kwargs, endpoint, data, rate_limit_args)
+
+@functools.lru_cache(maxsize=2048)
+def _escape_v2(text):
+    """MarkdownV2-escape text, memoized since users retry the same names"""
+    return escape_markdown(text, version=2)
+
+def _format_found_chat(template, chat):
+    """Fill a channel/group found template with the chat's details"""
+    # Use proper Markdown escaping
+    username_line = (
+        USERNAME_LINE_TEMPLATE.format(username=_escape_v2(chat.username))
+        if chat.username else ""
+    )
+    description_line = (
+        DESCRIPTION_LINE_TEMPLATE.format(description=_escape_v2(chat.description[:100]))
+        if chat.description else ""
+    )
+    # Numeric IDs go into a code span and never need escaping
+    return template.format(
+        title=_escape_v2(chat.title) if chat.title else "N/A",
+        username_line=username_line,
+        chat_id=chat.id,
+        chat_type=_escape_v2(chat.type),
+        description_line=description_line
+    )
 
-# Search states for users (keyed by (chat_id, user_id) tuple)
-user_search_states = {}
+def _is_required_channel(chat):
+    """Check whether chat is the channel configured in CHANNEL_ID"""
+    if CHANNEL_ID.startswith('@'):
+        return bool(chat.username) and chat.username.lower() == CHANNEL_ID[1:].lower()
+    return str(chat.id) == CHANNEL_ID
+
+def button_callback(requires_subscription=True, answers_query=False):
+    """Wrap an inline button handler with the shared subscription check, answer and error handling
+    
+    The query is answered as soon as the subscription check passes, while the handler does its
+    work. Handlers marked answers_query may answer it themselves (e.g. with an alert); they return
+    True when they did, so it isn't answered twice.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+            if not update.callback_query or not update.callback_query.from_user:
+                return
+            
+            query = update.callback_query
+            ack = None
+            try:
+                if requires_subscription and not await self.is_subscribed(context, query.from_user.id):
+                    await query.answer("❌ Avval kanalga obuna bo'ling!", show_alert=True)
+                    return
+                
+                if not answers_query:
+                    # Stop the button's loading spinner right away instead of after the edit
+                    ack = asyncio.create_task(query.answer())
+                answered = await handler(self, update, context, query)
+                if ack:
+                    await ack
+                elif not answered:
+                    await query.answer()
+                
+            except Exception as e:
+                logger.error("Error in button handler: %s", e)
+                if ack:
+                    # Already answered, just make sure the answer task has finished
+                    await asyncio.gather(ack, return_exceptions=True)
+                else:
+                    await query.answer("❌ Xatolik yuz berdi. Qaytadan urinib ko'ring.")
+        return wrapper
+    return decorator
 
 class TelegramBot:
     def __init__(self):
         if not BOT_TOKEN:
             raise ValueError("BOT_TOKEN is required")
-        self.application = Application.builder().token(BOT_TOKEN).build()
+        # Larger connection pools keep HTTP connections to the Bot API alive under load, and
+        # HTTP/2 lets concurrent calls share a connection instead of waiting on each other.
+        # getUpdates stays on HTTP/1.1 with a small pool: long polling sends one request at a
+        # time, and PTB warns that HTTP/2 can be unstable for it (cancelled keep-alive connections).
+        # The rate limiter queues API calls below Telegram's overall limit (30 msg/s) and messages
+        # into a group or channel below its per-chat limit (20 msg/min). Subscription lookups
+        # (get_chat_member on the channel) only count towards the overall rate, see MessageRateLimiter.
+        # Responses are parsed with orjson (if installed) instead of the json module.
+        # Updates are processed concurrently (up to 256 at once) so one user's slow
+        # API call does not hold up everyone else
+        self.application = (
+            Application.builder()
+            .token(BOT_TOKEN)
+            .request(OrjsonRequest(
+                connection_pool_size=256, pool_timeout=30, connect_timeout=10, read_timeout=30, http_version="2"
+            ))
+            .get_updates_request(OrjsonRequest(connection_pool_size=2))
+            .rate_limiter(MessageRateLimiter(
+                overall_max_rate=28,
+                overall_time_period=1,
+                group_max_rate=18,
+                group_time_period=60,
+                max_retries=3
+            ))
+            .concurrent_updates(256)
+            .persistence(PicklePersistence(
+                filepath=PERSISTENCE_FILE,
+                store_data=PersistenceInput(chat_data=False, user_data=False, callback_data=False),
+                on_flush=True
+            ))
+            .build()
+        )
+        self._health_runner = None
+        # Number of /start calls so far, reported by the health endpoint
+        self.user_count = 0
+        # Recent subscription results (user_id -> (checked_at, is_member)), oldest first
+        self._sub_cache = OrderedDict()
+        # In-flight subscription checks (user_id -> task) so concurrent checks for one user share a single API call
+        self._sub_fetches = {}
+        
+        # Telegram file_id of the warning image once it has been sent, so it isn't fetched from the URL again
+        self._warning_file_id = None
+        
         self.setup_handlers()
     
     def setup_handlers(self):
         """Set up command and callback handlers"""
         self.application.add_handler(CommandHandler("start", self.start))
         self.application.add_handler(CommandHandler("check_subscription", self.check_subscription))
-        self.application.add_handler(CallbackQueryHandler(self.button_handler))
+        # Inline buttons are routed by their callback_data
+        self.application.add_handler(CallbackQueryHandler(self._cb_check_subscription, pattern="^check_subscription$"))
+        self.application.add_handler(CallbackQueryHandler(self._cb_search_user, pattern="^search_user$"))
+        self.application.add_handler(CallbackQueryHandler(self._cb_search_channel, pattern="^search_channel$"))
+        self.application.add_handler(CallbackQueryHandler(self._cb_search_group, pattern="^search_group$"))
+        self.application.add_handler(CallbackQueryHandler(self._cb_search_back, pattern="^search_back$"))
+        # Answer buttons left over from older bot versions so their spinner stops
+        self.application.add_handler(CallbackQueryHandler(self.unknown_button))
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_text_message))
+        # Channel joins and leaves (the bot must be a channel admin to receive them)
+        self.application.add_handler(ChatMemberHandler(self.track_channel_member, ChatMemberHandler.CHAT_MEMBER))
+    
+    @property
+    def subscribed_users(self):
+        """Known channel members (user_id -> time last confirmed), saved in bot_data across restarts"""
+        members = self.application.bot_data.get("subscribed_users")
+        if not isinstance(members, dict):
+            # Older versions saved a plain set without confirmation times, so start over
+            members = self.application.bot_data["subscribed_users"] = {}
+        return members
     
     async def is_subscribed(self, context, user_id):
         """Check if user is subscribed to the required channel"""
         if not CHANNEL_ID:
             logger.warning("CHANNEL_ID not configured - allowing access for testing")
             return True
-            
+        
+        # Members seen in chat_member updates or confirmed recently need no API call
+        confirmed_at = self.subscribed_users.get(user_id)
+        if confirmed_at is not None and time.time() - confirmed_at < _MEMBER_MAX_AGE:
+            return True
+        
+        is_member = self._get_cached_subscription(user_id)
+        if is_member is not None:
+            return is_member
+        
+        # Concurrent checks for the same user wait for the one API call already in flight
+        fetch = self._sub_fetches.get(user_id)
+        if fetch is None:
+            fetch = asyncio.create_task(self._fetch_subscription(context, user_id))
+            self._sub_fetches[user_id] = fetch
+            fetch.add_done_callback(lambda _: self._sub_fetches.pop(user_id, None))
+        # A cancelled caller must not cancel the call the other callers are waiting for
+        return await asyncio.shield(fetch)
+    
+    async def _fetch_subscription(self, context, user_id):
+        """Ask Telegram for the user's channel membership and cache the result"""
         try:
-            logger.info(f"Checking subscription for user {user_id} in channel {CHANNEL_ID}")
+            logger.info("Checking subscription for user %s in channel %s", user_id, CHANNEL_ID)
+            started = time.monotonic()
             member = await context.bot.get_chat_member(CHANNEL_ID, user_id)
-            logger.info(f"User {user_id} status in channel: {member.status}")
-            is_member = member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]
-            logger.info(f"User {user_id} subscription check result: {is_member}")
-            return is_member
+            logger.info("User %s status in channel: %s", user_id, member.status)
+            is_member = member.status in _SUBSCRIBED_STATUSES
+            logger.info("User %s subscription check result: %s", user_id, is_member)
         except Exception as e:
-            logger.error(f"Error checking subscription for user {user_id} in channel {CHANNEL_ID}: {e}")
-            logger.error(f"Error type: {type(e).__name__}")
+            logger.error("Error checking subscription for user %s in channel %s: %s", user_id, CHANNEL_ID, e)
+            logger.error("Error type: %s", type(e).__name__)
             # For development/testing, return False so users see the subscription prompt
             # In production with proper setup, this should return False
+            # Errors are not cached so the next check retries
             return False
+        
+        # A chat_member update handled while we were waiting is newer than this answer
+        entry = self._sub_cache.get(user_id)
+        if entry is not None and entry[0] >= started:
+            return entry[1]
+        
+        self._set_cached_subscription(user_id, is_member)
+        if is_member:
+            self.subscribed_users[user_id] = time.time()
+        else:
+            self.subscribed_users.pop(user_id, None)
+        return is_member
+    
+    def _get_cached_subscription(self, user_id):
+        """Return the cached subscription result, or None if missing or expired"""
+        entry = self._sub_cache.get(user_id)
+        if entry is None:
+            return None
+        checked_at, is_member = entry
+        if time.monotonic() - checked_at >= _SUB_TTL:
+            del self._sub_cache[user_id]
+            return None
+        return is_member
+    
+    def _set_cached_subscription(self, user_id, is_member):
+        """Store a subscription result, evicting the oldest entry when full"""
+        self._sub_cache[user_id] = (time.monotonic(), is_member)
+        self._sub_cache.move_to_end(user_id)
+        if len(self._sub_cache) > _SUB_CACHE_MAXSIZE:
+            self._sub_cache.popitem(last=False)
+    
+    def _invalidate_cached_subscription(self, user_id):
+        """Forget the cached subscription result and known membership so the next check asks Telegram"""
+        self._sub_cache.pop(user_id, None)
+        self.subscribed_users.pop(user_id, None)
+    
+    async def track_channel_member(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Keep subscribed_users current from the required channel's member updates"""
+        member_update = update.chat_member
+        if not CHANNEL_ID or not member_update or not _is_required_channel(member_update.chat):
+            return
+        
+        user_id = member_update.new_chat_member.user.id
+        is_member = member_update.new_chat_member.status in _SUBSCRIBED_STATUSES
+        if is_member:
+            self.subscribed_users[user_id] = time.time()
+        else:
+            self.subscribed_users.pop(user_id, None)
+        self._set_cached_subscription(user_id, is_member)
+        logger.info("User %s channel status changed to %s", user_id, member_update.new_chat_member.status)
     
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
         if not update.effective_user or not update.message:
             return
             
-        global user_count
         user_id = update.effective_user.id
         user_name = update.effective_user.first_name or "Foydalanuvchi"
-        user_count += 1
+        user_num = next(_user_counter)
+        self.user_count = user_num
         
-        # Welcome message with user name and number
-        welcome_text = (
-            f"👋 Salom, **{user_name}** botimizga xush kelibsiz! "
-            f"Siz botdagi **{user_count}**-foydalanuvchi bo'ldingiz. "
-            f"💬 Bu bot orqali foydalanuvchi, guruh va kanallarning ID'sini olish imkoniyatiga ega bo'lasiz. "
-            f"⭐ Botga start tugmasini bosib, ish faoliyatini boshlang."
-        )
+        welcome_text = WELCOME_TEMPLATE.format(name=html.escape(user_name), count=user_num)
         
-        await update.message.reply_text(welcome_text, parse_mode='Markdown')
+        # Send the welcome and check subscription at the same time, they don't depend on each other
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(update.message.reply_text(welcome_text, parse_mode='HTML'))
+            sub_task = tg.create_task(self.is_subscribed(context, user_id))
         
-        # Check subscription
-        if await self.is_subscribed(context, user_id):
+        if sub_task.result():
             await self.show_subscribed_message(update)
         else:
             await self.show_subscription_required(update)
@@ -100,64 +493,31 @@ class TelegramBot:
         if not update.message:
             return
             
-        text = "⚠️ Botdan foydalanish uchun quyidagi kanalga obuna bo'ling."
-        
-        # Create subscription button URL
-        subscribe_url = None
-        
-        # Priority 1: Use CHANNEL_URL if provided
-        if CHANNEL_URL:
-            if CHANNEL_URL.startswith('https://') or CHANNEL_URL.startswith('http://'):
-                subscribe_url = CHANNEL_URL
-            elif CHANNEL_URL.startswith('@'):
-                subscribe_url = f"https://t.me/{CHANNEL_URL[1:]}"
-        
-        # Priority 2: Derive URL from CHANNEL_ID if it starts with @
-        elif CHANNEL_ID and CHANNEL_ID.startswith('@'):
-            subscribe_url = f"https://t.me/{CHANNEL_ID[1:]}"
-        
-        # Priority 3: Show channel ID in message for numeric IDs
-        elif CHANNEL_ID:
-            text += f"\n\n🆔 Kanal ID: `{CHANNEL_ID}`\n📝 Admin bilan bog'laning yoki kanalning public username'ini so'rang."
-        
-        # Create keyboard
-        keyboard = []
-        if subscribe_url:
-            keyboard.append([InlineKeyboardButton("✅ Obuna bo'lish", url=subscribe_url)])
-        
-        keyboard.append([InlineKeyboardButton("🔄 Tekshirish", callback_data="check_subscription")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        try:
-            if WARNING_IMAGE_URL and WARNING_IMAGE_URL != "https://example.com/warning.png":
-                await update.message.reply_photo(
-                    photo=WARNING_IMAGE_URL,
-                    caption=text,
-                    reply_markup=reply_markup,
-                    parse_mode='Markdown'
+        if SEND_WARNING_IMAGE:
+            try:
+                message = await update.message.reply_photo(
+                    photo=self._warning_file_id or WARNING_IMAGE_URL,
+                    caption=SUBSCRIPTION_TEXT,
+                    reply_markup=SUBSCRIPTION_MARKUP,
+                    parse_mode='HTML'
                 )
-            else:
-                await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
-        except Exception as e:
-            logger.error(f"Error sending subscription message: {e}")
-            # Fallback to simple text message
-            await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='Markdown')
+                if message.photo:
+                    self._warning_file_id = message.photo[-1].file_id
+                return
+            except Exception as e:
+                # The image could not be sent (e.g. bad URL), fall back to a text message
+                logger.error("Error sending subscription message: %s", e)
+                # Retry from the URL next time in case the cached file_id is no longer valid
+                self._warning_file_id = None
+        
+        await update.message.reply_text(SUBSCRIPTION_TEXT, reply_markup=SUBSCRIPTION_MARKUP, parse_mode='HTML')
     
     async def show_subscribed_message(self, update):
         """Show message for subscribed users with search options only"""
         if not update.message:
             return
             
-        text = "✅ Obuna bo'lingan! Siz botdan foydalanishingiz mumkin.\n\n🔍 Qidirish turini tanlang:"
-        
-        keyboard = [
-            [InlineKeyboardButton("👤 Foydalanuvchi qidirish", callback_data="search_user")],
-            [InlineKeyboardButton("📺 Kanal qidirish", callback_data="search_channel")],
-            [InlineKeyboardButton("👥 Guruh qidirish", callback_data="search_group")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(text, reply_markup=reply_markup)
+        await update.message.reply_text(SEARCH_MENU_TEXT, reply_markup=SEARCH_MENU_MARKUP)
     
     async def check_subscription(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /check_subscription command"""
@@ -166,100 +526,80 @@ class TelegramBot:
             
         user_id = update.effective_user.id
         
+        # An explicit check must see a fresh status, e.g. right after subscribing
+        self._invalidate_cached_subscription(user_id)
         if await self.is_subscribed(context, user_id):
             await self.show_subscribed_message(update)
         else:
             await self.show_subscription_required(update)
     
-    async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle inline button callbacks"""
-        if not update.callback_query or not update.callback_query.from_user:
-            return
-            
-        query = update.callback_query
-        user_id = query.from_user.id
-        
-        try:
-            if query.data == "check_subscription":
-                if await self.is_subscribed(context, user_id):
-                    text = "✅ Obuna bo'lingan! Siz botdan foydalanishingiz mumkin.\n\n🔍 Qidirish turini tanlang:"
-                    keyboard = [
-                        [InlineKeyboardButton("👤 Foydalanuvchi qidirish", callback_data="search_user")],
-                        [InlineKeyboardButton("📺 Kanal qidirish", callback_data="search_channel")],
-                        [InlineKeyboardButton("👥 Guruh qidirish", callback_data="search_group")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    # Try to edit message, if it fails, send new message
-                    try:
-                        await query.edit_message_text(text, reply_markup=reply_markup)
-                    except:
-                        # If editing fails (maybe it was a photo message), delete and send new
-                        if query.message:
-                            try:
-                                await query.message.delete()
-                            except:
-                                pass
-                            await context.bot.send_message(
-                                chat_id=query.message.chat_id,
-                                text=text,
-                                reply_markup=reply_markup
-                            )
-                else:
-                    await query.answer("❌ Siz hali kanalga obuna bo'lmagansiz. Iltimos, avval kanalga obuna bo'ling.", show_alert=True)
-                    
-            elif query.data == "search_user":
-                if await self.is_subscribed(context, user_id):
-                    chat_id = query.message.chat.id if query.message else None
-                    user_search_states[(chat_id, user_id)] = "waiting_user_search"
-                    text = "👤 **Foydalanuvchi qidirish**\n\nFoydalanuvchi username'ini kiriting (masalan: @username yoki username):"
-                    if query.message:
-                        await query.edit_message_text(text, parse_mode='Markdown')
-                else:
-                    await query.answer("❌ Avval kanalga obuna bo'ling!", show_alert=True)
-                    
-            elif query.data == "search_channel":
-                if await self.is_subscribed(context, user_id):
-                    chat_id = query.message.chat.id if query.message else None
-                    user_search_states[(chat_id, user_id)] = "waiting_channel_search"
-                    text = "🔍 **Kanal qidirish**\n\nKanal username'ini kiriting (masalan: @channelname yoki channelname):"
-                    if query.message:
-                        await query.edit_message_text(text, parse_mode='Markdown')
-                else:
-                    await query.answer("❌ Avval kanalga obuna bo'ling!", show_alert=True)
-                    
-            elif query.data == "search_group":
-                if await self.is_subscribed(context, user_id):
-                    chat_id = query.message.chat.id if query.message else None
-                    user_search_states[(chat_id, user_id)] = "waiting_group_search"
-                    text = "🔍 **Guruh qidirish**\n\nGuruh username'ini kiriting (masalan: @groupname yoki groupname):"
-                    if query.message:
-                        await query.edit_message_text(text, parse_mode='Markdown')
-                else:
-                    await query.answer("❌ Avval kanalga obuna bo'ling!", show_alert=True)
-                    
-            elif query.data == "search_back":
-                if await self.is_subscribed(context, user_id):
-                    chat_id = query.message.chat.id if query.message else None
-                    user_search_states.pop((chat_id, user_id), None)
-                    text = "✅ Obuna bo'lingan! Siz botdan foydalanishingiz mumkin.\n\n🔍 Qidirish turini tanlang:"
-                    keyboard = [
-                        [InlineKeyboardButton("👤 Foydalanuvchi qidirish", callback_data="search_user")],
-                        [InlineKeyboardButton("📺 Kanal qidirish", callback_data="search_channel")],
-                        [InlineKeyboardButton("👥 Guruh qidirish", callback_data="search_group")]
-                    ]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    if query.message:
-                        await query.edit_message_text(text, reply_markup=reply_markup)
-                else:
-                    await query.answer("❌ Avval kanalga obuna bo'ling!", show_alert=True)
-            
-            await query.answer()
+    async def unknown_button(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Answer inline buttons that no handler is registered for"""
+        if update.callback_query:
+            await update.callback_query.answer()
+    
+    @button_callback(requires_subscription=False, answers_query=True)
+    async def _cb_check_subscription(self, update, context, query):
+        """Re-check the subscription and show the search menu"""
+        # The user presses this right after subscribing, so don't trust a cached "not subscribed"
+        self._invalidate_cached_subscription(query.from_user.id)
+        if await self.is_subscribed(context, query.from_user.id):
+            # Photo messages have no text to edit, so replace them straight away
+            if query.message and query.message.photo:
+                await self._resend_message(query, context, SEARCH_MENU_TEXT, SEARCH_MENU_MARKUP)
+                return
             
-        except Exception as e:
-            logger.error(f"Error in button handler: {e}")
-            await query.answer("❌ Xatolik yuz berdi. Qaytadan urinib ko'ring.")
+            # Try to edit message in place, if it fails, send new message
+            try:
+                await query.edit_message_text(SEARCH_MENU_TEXT, reply_markup=SEARCH_MENU_MARKUP)
+            except BadRequest:
+                await self._resend_message(query, context, SEARCH_MENU_TEXT, SEARCH_MENU_MARKUP)
+        else:
+            await query.answer("❌ Siz hali kanalga obuna bo'lmagansiz. Iltimos, avval kanalga obuna bo'ling.", show_alert=True)
+            return True
+    
+    async def _resend_message(self, query, context, text, reply_markup):
+        """Delete the button's message and send the text as a new message"""
+        if not query.message:
+            return
+        # The message may already be gone or too old to delete
+        with suppress(TelegramError):
+            await query.message.delete()
+        await context.bot.send_message(
+            chat_id=query.message.chat_id,
+            text=text,
+            reply_markup=reply_markup
+        )
+    
+    @button_callback()
+    async def _cb_search_user(self, update, context, query):
+        """Ask for a username to search"""
+        await self._start_search(query, "waiting_user_search")
+    
+    @button_callback()
+    async def _cb_search_channel(self, update, context, query):
+        """Ask for a channel username to search"""
+        await self._start_search(query, "waiting_channel_search")
     
+    @button_callback()
+    async def _cb_search_group(self, update, context, query):
+        """Ask for a group username to search"""
+        await self._start_search(query, "waiting_group_search")
+    
+    async def _start_search(self, query, search_state):
+        """Put the user into a search state and show the search prompt"""
+        chat_id = query.message.chat.id if query.message else None
+        user_search_states[(chat_id, query.from_user.id)] = search_state
+        if query.message:
+            await query.edit_message_text(SEARCH_KINDS[search_state].prompt, parse_mode='HTML')
+    
+    @button_callback()
+    async def _cb_search_back(self, update, context, query):
+        """Leave the search state and go back to the search menu"""
+        chat_id = query.message.chat.id if query.message else None
+        user_search_states.pop((chat_id, query.from_user.id), None)
+        if query.message:
+            await query.edit_message_text(SEARCH_MENU_TEXT, reply_markup=SEARCH_MENU_MARKUP)
     
     async def handle_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle text messages for search functionality"""
@@ -274,169 +614,128 @@ class TelegramBot:
         if not chat_id:
             return
         
+        # Check if user is in a search state first (a single lookup, the entry may expire at any time),
+        # so ordinary chatter never costs a subscription check
+        kind = SEARCH_KINDS.get(user_search_states.get((chat_id, user_id)))
+        if not kind:
+            return
+        
         # Check if user is subscribed before processing search
         if not await self.is_subscribed(context, user_id):
             return
         
-        # Check if user is in a search state
-        if (chat_id, user_id) in user_search_states:
-            search_state = user_search_states[(chat_id, user_id)]
-            
-            if search_state == "waiting_user_search":
-                await self.search_user(update, context, text)
-            elif search_state == "waiting_channel_search":
-                await self.search_channel(update, context, text)
-            elif search_state == "waiting_group_search":
-                await self.search_group(update, context, text)
-                
-    async def search_user(self, update, context, username):
-        """Search for user by username"""
-        user_id = update.effective_user.id
-        chat_id = update.effective_chat.id
-        
-        # Clean the username
-        if username.startswith('@'):
-            username = username[1:]
-        
-        try:
-            # Try to get user info by searching for them
-            # Note: Telegram Bot API doesn't allow searching for users directly by username
-            # We can only get user info if we have their ID or if they interact with the bot
-            # So we'll provide a helpful message about this limitation
-            
-            # Clear search state
-            user_search_states.pop((chat_id, user_id), None)
-            
-            # Inform user about the limitation
-            clean_username = escape_markdown(username, version=2)
-            text = f"⚠️ **Foydalanuvchi qidirish cheklovi**\n\n"
-            text += f"Afsuski, Telegram Bot API orqali @{clean_username} foydalanuvchisini username bo\'yicha qidirish mumkin emas\.\n\n"
-            text += f"**Foydalanuvchi ID\-sini olish usullari:**\n"
-            text += f"• Foydalanuvchi botga yozishi va /start bosishi kerak\n"
-            text += f"• Yoki foydalanuvchini guruhlarda mention qilib, bot orqali ID\-sini olish mumkin\n\n"
-            text += f"**Maslahat:** Kanal yoki guruh qidirish funksiyasidan foydalaning\!"
-            
-        except Exception as e:
-            logger.error(f"Error in user search: {e}")
-            user_search_states.pop((chat_id, user_id), None)
-            clean_username = escape_markdown(username, version=2)
-            text = f"❌ **Xatolik yuz berdi\!**\n\n@{clean_username} foydalanuvchisini qidirishda xatolik yuz berdi\."
-            
-        keyboard = [[InlineKeyboardButton("⬅️ Orqaga", callback_data="search_back")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='MarkdownV2')
+        await self.search(update, context, text, kind)
     
-    async def search_channel(self, update, context, channel_name):
-        """Search for channel by username"""
+    async def search(self, update, context, name, kind):
+        """Search for a user, channel or group by username"""
         user_id = update.effective_user.id
         chat_id = update.effective_chat.id
         
-        # Clean the channel name
-        if channel_name.startswith('@'):
-            channel_name = channel_name[1:]
+        # Clean the name
+        if name.startswith('@'):
+            name = name[1:]
+        clean_name = _escape_v2(name)
         
-        try:
-            # Try to get channel info
-            channel = await context.bot.get_chat(f"@{channel_name}")
-            
-            # Clear search state only on success
-            user_search_states.pop((chat_id, user_id), None)
-            
-            # Use proper Markdown escaping
-            title = escape_markdown(channel.title, version=2) if channel.title else "N/A"
-            username = escape_markdown(channel.username, version=2) if channel.username else "N/A"
-            channel_id = escape_markdown(str(channel.id), version=2)
-            channel_type = escape_markdown(channel.type, version=2)
-            
-            text = f"✅ **Kanal topildi\!**\n\n"
-            text += f"📺 **Nomi:** {title}\n"
-            text += f"🆔 **Username:** @{username}\n" if channel.username else ""
-            text += f"🆔 **ID:** `{channel_id}`\n"
-            text += f"👥 **Turi:** {channel_type}\n"
-            
-            if channel.description:
-                desc = escape_markdown(channel.description[:100], version=2)
-                text += f"📝 **Tavsif:** {desc}\.\.\."
-            
-        except Exception as e:
-            logger.error(f"Error searching channel @{channel_name}: {e}")
-            clean_channel_name = escape_markdown(channel_name, version=2)
-            text = f"❌ **Kanal topilmadi\!**\n\n@{clean_channel_name} kanal topilmadi yoki bot unga kirish huquqiga ega emas\.\n\n💡 **Maslahatlar:**\n\u2022 Kanal username'i to'g'ri yozilganligini tekshiring\n\u2022 Kanal ochiq \(public\) bo'lishi kerak\n\u2022 Kanal mavjudligini tekshiring"
-            
-        keyboard = [[InlineKeyboardButton("⬅️ Orqaga", callback_data="search_back")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        if kind.needs_api_call:
+            try:
+                chat = await context.bot.get_chat(f"@{name}")
+            except Exception as e:
+                # Keep the search state so the user can try another name
+                logger.error("Error searching %s @%s: %s", kind.label, name, e)
+                text = kind.not_found_template.format(name=clean_name)
+                await update.message.reply_text(text, reply_markup=BACK_MARKUP, parse_mode='MarkdownV2')
+                return
+            text = _format_found_chat(kind.found_template, chat)
+        else:
+            text = kind.found_template.format(name=clean_name)
         
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='MarkdownV2')
+        # Clear search state only on success
+        user_search_states.pop((chat_id, user_id), None)
+        await update.message.reply_text(text, reply_markup=BACK_MARKUP, parse_mode='MarkdownV2')
     
-    async def search_group(self, update, context, group_name):
-        """Search for group by username"""
-        user_id = update.effective_user.id
-        chat_id = update.effective_chat.id
-        
-        # Clean the group name
-        if group_name.startswith('@'):
-            group_name = group_name[1:]
+    async def start_health_server(self):
+        """Serve the health check endpoints on the bot's event loop"""
+        port = int(os.environ.get('PORT', 5000))
+        # Health probes arrive every few seconds, don't write an access log line for each one
+        self._health_runner = web.AppRunner(app, access_log=None)
+        await self._health_runner.setup()
+        await web.TCPSite(self._health_runner, '0.0.0.0', port).start()
+        logger.info("Health check server listening on port %s", port)
+    
+    async def stop_health_server(self):
+        """Stop the health check server"""
+        if self._health_runner:
+            await self._health_runner.cleanup()
+            self._health_runner = None
+    
+    async def run(self):
+        """Run the bot using polling with the health check server on the same event loop"""
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                # Signal handlers are not available on Windows, Ctrl+C still stops asyncio.run
+                pass
         
         try:
-            # Try to get group info
-            group = await context.bot.get_chat(f"@{group_name}")
-            
-            # Clear search state only on success
-            user_search_states.pop((chat_id, user_id), None)
-            
-            # Use proper Markdown escaping
-            title = escape_markdown(group.title, version=2) if group.title else "N/A"
-            username = escape_markdown(group.username, version=2) if group.username else "N/A"
-            group_id = escape_markdown(str(group.id), version=2)
-            group_type = escape_markdown(group.type, version=2)
-            
-            text = f"✅ **Guruh topildi\!**\n\n"
-            text += f"👥 **Nomi:** {title}\n"
-            text += f"🆔 **Username:** @{username}\n" if group.username else ""
-            text += f"🆔 **ID:** `{group_id}`\n"
-            text += f"👥 **Turi:** {group_type}\n"
-            
-            if group.description:
-                desc = escape_markdown(group.description[:100], version=2)
-                text += f"📝 **Tavsif:** {desc}\.\.\."
-            
-        except Exception as e:
-            logger.error(f"Error searching group @{group_name}: {e}")
-            clean_group_name = escape_markdown(group_name, version=2)
-            text = f"❌ **Guruh topilmadi\!**\n\n@{clean_group_name} guruh topilmadi yoki bot unga kirish huquqiga ega emas\.\n\n💡 **Maslahatlar:**\n\u2022 Guruh username'i to'g'ri yozilganligini tekshiring\n\u2022 Guruh ochiq \(public\) bo'lishi kerak\n\u2022 Guruh mavjudligini tekshiring"
-            
-        keyboard = [[InlineKeyboardButton("⬅️ Orqaga", callback_data="search_back")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        await update.message.reply_text(text, reply_markup=reply_markup, parse_mode='MarkdownV2')
-    
-    def run(self):
-        """Run the bot using polling"""
-        self.application.run_polling()
+            async with self.application:
+                # Everything started here is stopped in finally, even if a later step fails,
+                # so the application can shut down and the original error isn't hidden
+                try:
+                    await self.start_health_server()
+                    await self.application.start()
+                    # Only ask for the update types the handlers use, so Telegram filters out the rest.
+                    # chat_member updates are only delivered when they are requested explicitly.
+                    await self.application.updater.start_polling(
+                        allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY, Update.CHAT_MEMBER]
+                    )
+                    await stop_event.wait()
+                finally:
+                    if self.application.updater.running:
+                        await self.application.updater.stop()
+                    if self.application.running:
+                        await self.application.stop()
+                    await self.stop_health_server()
+        finally:
+            # Give SIGINT/SIGTERM back their default behaviour once the bot has stopped
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                with suppress(NotImplementedError):
+                    loop.remove_signal_handler(sig)
 
-# Flask app for Render.com deployment
-app = Flask(__name__)
-
-@app.route('/')
-def health_check():
+# Health check web app for Render.com deployment
+async def health_check(request):
     """Health check endpoint"""
-    return "Bot is running", 200
+    return web.Response(text="Bot is running")
 
-@app.route('/health')
-def health():
-    """Health check endpoint"""
-    return "OK", 200
+async def health(request):
+    """Health check endpoint with basic bot statistics"""
+    if bot_instance is None:
+        return web.json_response({"status": "starting"})
+    return web.json_response({
+        "status": "ok",
+        "queue": bot_instance.application.update_queue.qsize(),
+        "subscribed": len(bot_instance.subscribed_users),
+        "users": bot_instance.user_count
+    })
 
-def run_flask():
-    """Run Flask server"""
-    port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port, debug=False)
+# The running bot, read directly by the health endpoint (same event loop, no locking needed)
+bot_instance = None
+
+app = web.Application()
+app.router.add_get('/', health_check)
+app.router.add_get('/health', health)
 
 def run_bot():
-    """Run Telegram bot"""
-    bot = TelegramBot()
-    bot.run()
+    """Run Telegram bot together with the health check server"""
+    global bot_instance
+    bot_instance = TelegramBot()
+    if uvloop is not None:
+        # Runs on a uvloop event loop without changing the process-wide loop policy
+        uvloop.run(bot_instance.run())
+    else:
+        asyncio.run(bot_instance.run())
 
 if __name__ == '__main__':
     # Check if required environment variables are set
@@ -447,11 +746,6 @@ if __name__ == '__main__':
     if not CHANNEL_ID:
         logger.warning("CHANNEL_ID environment variable is not set - bot will allow all users for testing")
     
-    logger.info("Starting Telegram bot and Flask server...")
-    
-    # Start Flask server in a separate thread
-    flask_thread = Thread(target=run_flask, daemon=True)
-    flask_thread.start()
+    logger.info("Starting Telegram bot and health check server...")
     
-    # Run bot in main thread
     run_bot()
\ No newline at end of file